@@ -2,15 +2,29 @@
 Streamlit control center for the matching workflow.
 Credentials: configure in .streamlit/secrets.toml (e.g. connections.gsheets).
 """
+import functools
+import hashlib
+import json
+import os
+
 import streamlit as st
 import pandas as pd
+from pandas.io.parsers import TextParser
 from streamlit_gsheets import GSheetsConnection
+from streamlit_gsheets.gsheets_connection import GSheetsServiceAccountClient
 
-from match_maker_automated import run_matching_workflow
+from match_maker_automated import (
+    HEURISTIC_THRESHOLD,
+    build_compatibility_graph,
+    run_matching_workflow,
+    transform_sheet_history_to_dict,
+)
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# SET THIS TO TRUE TO TEST WITHOUT CREDENTIALS
-TEST_MODE = True
+# Run with ELLEVATE_TEST=1 to test without credentials (mock data, no Tray push)
+TEST_MODE = os.getenv("ELLEVATE_TEST", "") == "1"
 
 st.set_page_config(page_title="Match Maker Control Center", layout="wide")
 st.title("Match Maker Control Center")
@@ -18,25 +32,57 @@ st.title("Match Maker Control Center")
 # ---------------------------------------------------------------------------
 # Data connection: load from Google Sheets
 # ---------------------------------------------------------------------------
-@st.cache_data(ttl=300)
+SHEET_TABS = ["Participants", "MatchHistory"]
+
+def values_to_frame(value_range):
+    """
+    Turn one batchGet valueRange into a DataFrame the way conn.read() does
+    (gspread_dataframe): TextParser for header dedup and type inference,
+    then drop empty rows and empty unnamed columns.
+    """
+    rows = value_range.get("values", [])
+    if not rows:
+        return pd.DataFrame()
+    # The API omits trailing blank cells, so pad every row to the same width
+    width = max(len(r) for r in rows)
+    df = TextParser([r + [""] * (width - len(r)) for r in rows]).read()
+    df = df.dropna(how="all")
+    unnamed_empty = df.columns.str.startswith("Unnamed:") & df.isna().all().to_numpy()
+    return df.loc[:, ~unnamed_empty]
+
+@functools.cache
+def mock_sheet_data():
+    """Static participants/history used in TEST_MODE; built once per process."""
+    mock_participants = pd.DataFrame([
+        {"Name": "Alice Smith", "Email": "alice@test.com", "Include": True},
+        {"Name": "Bob Jones", "Email": "bob@test.com", "Include": True},
+        {"Name": "Charlie Brown", "Email": "charlie@test.com", "Include": True},
+        {"Name": "Diana Prince", "Email": "diana@test.com", "Include": True},
+        {"Name": "Edward Nigma", "Email": "edward@test.com", "Include": True},
+    ])
+    mock_history = pd.DataFrame([
+        {"Person A (Email)": "alice@test.com", "Person B (Email)": "bob@test.com", "Match Date": "2024-01-01"}
+    ])
+    return mock_participants, mock_history
+
+# cache_resource hands back the cached frames as-is instead of unpickling a
+# copy on every rerun; callers must treat them as read-only.
+@st.cache_resource(ttl=300)
 def load_sheet_data():
     """Load from Sheets, or return Mock Data if testing."""
 
     if TEST_MODE:
-        mock_participants = pd.DataFrame([
-            {"Name": "Alice Smith", "Email": "alice@test.com", "Include": True},
-            {"Name": "Bob Jones", "Email": "bob@test.com", "Include": True},
-            {"Name": "Charlie Brown", "Email": "charlie@test.com", "Include": True},
-            {"Name": "Diana Prince", "Email": "diana@test.com", "Include": True},
-            {"Name": "Edward Nigma", "Email": "edward@test.com", "Include": True},
-        ])
-        mock_history = pd.DataFrame([
-            {"Person A (Email)": "alice@test.com", "Person B (Email)": "bob@test.com", "Match Date": "2024-01-01"}
-        ])
-        return mock_participants, mock_history
+        return mock_sheet_data()
 
     # Original GSheets logic (runs when TEST_MODE is False)
     conn = st.connection("gsheets", type=GSheetsConnection)
+    if isinstance(conn.client, GSheetsServiceAccountClient):
+        # Fetch both tabs in a single values:batchGet round-trip
+        response = conn.client._open_spreadsheet().values_batch_get(SHEET_TABS)
+        participants_df, history_df = (values_to_frame(vr) for vr in response["valueRanges"])
+        return participants_df, history_df
+
+    # Public sheets can only be exported one worksheet at a time
     participants_df = conn.read(worksheet="Participants", ttl=300)
     history_df = conn.read(worksheet="MatchHistory", ttl=300)
     return participants_df, history_df
@@ -54,16 +100,10 @@ except Exception as e:
 # ---------------------------------------------------------------------------
 def normalize_participant_columns(df):
     """Ensure we have lowercase 'email' and 'name' for the matcher."""
-    df = df.copy()
-    col_map = {}
-    for c in df.columns:
-        c_lower = str(c).strip().lower()
-        if c_lower == "email":
-            col_map[c] = "email"
-        elif c_lower == "name":
-            col_map[c] = "name"
-    df = df.rename(columns=col_map)
-    return df
+    # rename() already returns a new frame, so no defensive copy is needed
+    return df.rename(columns={
+        c: str(c).strip().lower() for c in df.columns if str(c).strip().lower() in ("email", "name")
+    })
 
 participants_df = normalize_participant_columns(participants_df)
 if "email" not in participants_df.columns or "name" not in participants_df.columns:
@@ -91,25 +131,61 @@ edited_df = st.data_editor(
     use_container_width=True,
 )
 
-included_df = edited_df[edited_df["Include"] == True].drop(columns=["Include"], errors="ignore")
-active_participants = included_df.to_dict("records")
+def unique_columns(columns):
+    """String column names with repeats suffixed like pandas does ('Team', 'Team.1')."""
+    seen = {}
+    names = []
+    for c in map(str, columns):
+        if c in seen:
+            seen[c] += 1
+            c = f"{c}.{seen[c]}"
+            while c in seen:
+                c += "_"
+        seen.setdefault(c, 0)
+        names.append(c)
+    return names
+
 # Normalize so matcher sees 'email' and 'name'; keep full record for Tray
-def to_participant(r):
-    r = {k: v for k, v in r.items() if v is not None and str(v).strip() != ""}
-    email = str(r.get("email", "")).strip()
-    name = str(r.get("name", "")).strip()
-    if not email:
-        return None
-    r["email"], r["name"] = email, name
-    return r
-active_participants = [p for p in (to_participant(r) for r in active_participants) if p]
+def prepare_participants(df):
+    """Included rows with trimmed 'email'/'name' and no blank emails, as records."""
+    # to_records needs unique string field names; the first 'email'/'name' wins
+    df = df.set_axis(unique_columns(df.columns), axis=1)
+    df = df.loc[df["Include"] == True, df.columns != "Include"]
+    # Blank (empty or whitespace-only) cells reach Tray as null rather than NaN or ""
+    filled = df.notna() & df.apply(lambda col: col.astype(str).str.strip() != "")
+    df = df.astype(object).where(filled, None)
+    df = df.assign(
+        email=df["email"].fillna("").astype(str).str.strip(),
+        name=df["name"].fillna("").astype(str).str.strip(),
+    )
+    return df[df["email"] != ""].to_records(index=False)
+
+try:
+    active_participants = prepare_participants(edited_df)
+except Exception as e:
+    st.error(f"Could not read the participant table. Error: {e}")
+    st.stop()
 
 st.caption(f"{len(active_participants)} participant(s) included.")
 
 # ---------------------------------------------------------------------------
-# Raw MatchHistory for the matcher (list of dicts with Person A/B (Email))
+# Cached matcher inputs: reruns with unchanged data skip the rebuild
 # ---------------------------------------------------------------------------
-raw_history = history_df.to_dict("records") if not history_df.empty else []
+def records_key(records):
+    """Hashable form of a participant recarray for caching and fingerprints."""
+    return records.dtype.names, tuple(r.item() for r in records)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def cached_history(history_df):
+    return transform_sheet_history_to_dict(history_df)
+
+# cache_resource returns the live graph instead of pickling a copy per hit;
+# the matcher only reads it. The cache is shared by every session and each
+# Include selection adds a graph, so keep only a few.
+@st.cache_resource(ttl=300, max_entries=4, show_spinner=False)
+def cached_compatibility_graph(_participants, participants_key, history_df):
+    # Leading underscore: Streamlit keys the cache on participants_key instead
+    return build_compatibility_graph(_participants, cached_history(history_df))
 
 # ---------------------------------------------------------------------------
 # Generate Matches button
@@ -119,22 +195,49 @@ if st.button("Generate Matches", type="primary"):
     if len(active_participants) < 2:
         st.warning("Include at least 2 participants to generate matches.")
     else:
-        with st.spinner("Running matching workflow…"):
-            try:
-                results = run_matching_workflow(active_participants, raw_history)
-                st.session_state["match_results"] = results
-                st.session_state["match_results_generated"] = True
-                st.success("Matches generated. Review below and push to Tray when ready.")
-            except Exception as e:
-                st.error(f"Matching failed: {e}")
-                st.session_state["match_results_generated"] = False
+        # Fingerprint of the inputs; an unchanged fingerprint reuses the stored results
+        match_key = hashlib.blake2b(
+            json.dumps(
+                [records_key(active_participants), history_df.to_json(orient="values")],
+                sort_keys=True,
+                default=str,
+            ).encode(),
+            digest_size=8,
+        ).hexdigest()
+        if st.session_state.get("match_key") == match_key and st.session_state.get("match_results"):
+            st.session_state["match_results_generated"] = True
+            st.success("Matches generated. Review below and push to Tray when ready.")
+        else:
+            with st.spinner("Running matching workflow…"):
+                try:
+                    # Large groups use the greedy matcher, which doesn't need the graph
+                    G = None
+                    if len(active_participants) <= HEURISTIC_THRESHOLD:
+                        G = cached_compatibility_graph(
+                            active_participants, records_key(active_participants), history_df
+                        )
+                    results, unmatched = run_matching_workflow(
+                        active_participants,
+                        history_df,
+                        formatted_history=cached_history(history_df),
+                        G=G,
+                        report_unmatched=True,
+                    )
+                    st.session_state["match_results"] = results
+                    st.session_state["match_unmatched"] = unmatched
+                    st.session_state["match_key"] = match_key
+                    st.session_state["match_results_generated"] = True
+                    st.success("Matches generated. Review below and push to Tray when ready.")
+                except Exception as e:
+                    st.error(f"Matching failed: {e}")
+                    st.session_state["match_results_generated"] = False
 
 # ---------------------------------------------------------------------------
 # Preview results (pairs and triads)
 # ---------------------------------------------------------------------------
 st.header("3. Preview Results")
-if st.session_state.get("match_results_generated") and st.session_state.get("match_results"):
-    results = st.session_state["match_results"]
+if st.session_state.get("match_results_generated"):
+    results = st.session_state.get("match_results", [])
     pairs = [r for r in results if r.get("match_type") == "pair"]
     triads = [r for r in results if r.get("match_type") == "triad"]
 
@@ -150,6 +253,13 @@ if st.session_state.get("match_results_generated") and st.session_state.get("mat
             st.markdown(f"**{i}.** {a.get('name', '?')} · {b.get('name', '?')} · {c.get('name', '?')}")
 
     st.caption(f"Total: {len(pairs)} pair(s), {len(triads)} triad(s).")
+
+    # People who have already met every other compatible participant
+    # (or whom the large-group matcher couldn't place) aren't in the payload
+    unmatched = st.session_state.get("match_unmatched", [])
+    if unmatched:
+        names = ", ".join(p.get("name") or p.get("email", "?") for p in unmatched)
+        st.warning(f"{len(unmatched)} participant(s) could not be matched and won't be sent to Tray: {names}")
 else:
     st.info("Generate matches above to see results here.")
 
@@ -159,6 +269,19 @@ else:
 st.header("4. Push to Tray")
 webhook_url = st.secrets.get("tray_webhook_url") or st.secrets.get("TRAY_WEBHOOK_URL")
 
+@st.cache_resource
+def tray_session():
+    """Shared HTTP session so repeat pushes reuse the open TLS connection."""
+    session = requests.Session()
+    # Retry's default allowed_methods excludes POST, so only connection
+    # failures are retried and a delivered payload is never re-sent
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=4,
+        max_retries=Retry(total=2, backoff_factor=0.3),
+    ))
+    return session
+
 if st.button("Push to Tray", type="secondary"):
     if not st.session_state.get("match_results"):
         st.warning("Please generate matches in Step 2 first.")
@@ -170,28 +293,19 @@ if st.button("Push to Tray", type="secondary"):
         # --- PREPARE THE DATA FOR TRAY ---
         from datetime import datetime
         today = datetime.now().strftime("%Y-%m-%d")
-        history_updates = []
-
-        for m in results:
-            # 1. Standard Pair (A & B)
-            history_updates.append({
-                "Person A (Email)": m['person_a']['email'],
-                "Person B (Email)": m['person_b']['email'],
-                "Match Date": today
-            })
-            
-            # 2. Handle Triad connections (A-C and B-C)
-            if m['match_type'] == "triad":
-                history_updates.append({
-                    "Person A (Email)": m['person_a']['email'], 
-                    "Person B (Email)": m['person_c']['email'], 
-                    "Match Date": today
-                })
-                history_updates.append({
-                    "Person A (Email)": m['person_b']['email'], 
-                    "Person B (Email)": m['person_c']['email'], 
-                    "Match Date": today
-                })
+        triads = [m for m in results if m['match_type'] == "triad"]
+
+        # 1. Standard Pair (A & B) for every match, 2. Triad connections (A-C and B-C)
+        person_a = [m['person_a']['email'] for m in results]
+        person_b = [m['person_b']['email'] for m in results]
+        person_a += [m['person_a']['email'] for m in triads] + [m['person_b']['email'] for m in triads]
+        person_b += [m['person_c']['email'] for m in triads] * 2
+
+        history_updates = pd.DataFrame({
+            "Person A (Email)": person_a,
+            "Person B (Email)": person_b,
+            "Match Date": today,
+        }).to_dict("records")
 
         # The "Full Payload" contains everything Tray needs
         full_payload = {
@@ -207,7 +321,7 @@ if st.button("Push to Tray", type="secondary"):
             with st.spinner("Sending to Tray..."):
                 try:
                     # Send the combined payload
-                    r = requests.post(webhook_url, json=full_payload, timeout=30)
+                    r = tray_session().post(webhook_url, json=full_payload, timeout=30)
                     r.raise_for_status()
                     st.balloons()
                     st.success("Successfully pushed to Tray! Emails are being sent and history is updating.")
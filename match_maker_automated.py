@@ -1,103 +1,221 @@
 #!/usr/bin/env python3
 import networkx as nx
+import numpy as np
+import pandas as pd
 import random
-from typing import Dict, List, Set, Tuple, Optional
+from typing import Dict, Iterable, List, Set, Tuple, Optional
+
+HISTORY_COLUMNS = ['Person A (Email)', 'Person B (Email)']
+
+# Above this many participants the exact (O(N^3)) matching gets slow
+# (graph build + solve is ~0.1s at 200 but ~3s at 1000 on a complete graph),
+# so we fall back to greedy_matching
+HEURISTIC_THRESHOLD = 200
+
+def _canon(a: int, b: int) -> Tuple[int, int]:
+    """Order-independent key for a pair (cheaper than tuple(sorted(...)))"""
+    return (a, b) if a <= b else (b, a)
 
 # ==========================================
 # 1. CORE MATCHING ENGINE (The "Brain")
 # ==========================================
 
-def build_compatibility_graph(users: List[Dict], history: Dict[str, List[str]]) -> nx.Graph:
-    """
-    Nodes = People (by Email)
-    Edges = Possible matches (only if they haven't matched before)
+def build_compatibility_mask(users: List[Dict], met_pairs: Set[Tuple[int, int]]) -> np.ndarray:
     """
-    G = nx.Graph()
+    N x N boolean matrix indexed by int id.
+    True where two people could be matched (they haven't met before).
     
-    # Add nodes with metadata
-    for user in users:
-        # We use Email as the unique ID for simplicity in Sheets
-        email = user['email']
-        G.add_node(email, name=user['name'])
-    
-    user_emails = [user['email'] for user in users]
+    Args:
+        users: Participants already passed through index_participants
+        met_pairs: Past matches as id pairs (see history_to_id_pairs)
+    """
+    n = len(users)
     
-    # Add edges between people who have NOT matched before
-    for i, email1 in enumerate(user_emails):
-        for email2 in user_emails[i+1:]:
-            past_matches = history.get(email1, [])
-            if email2 not in past_matches:
-                G.add_edge(email1, email2)
+    # Mark every pair that has already met
+    met = np.zeros((n, n), dtype=bool)
+    for i, j in met_pairs:
+        met[i, j] = met[j, i] = True
     
+    # No self-loops
+    compatible = ~met
+    np.fill_diagonal(compatible, False)
+    return compatible
+
+def _graph_from_mask(mask: np.ndarray, users: List[Dict]) -> nx.Graph:
+    """Nodes = int ids (with the person's name), Edges = compatible pairs"""
+    G = nx.from_numpy_array(mask, edge_attr=None)
+    nx.set_node_attributes(G, {i: user['name'] for i, user in enumerate(users)}, 'name')
     return G
 
-def find_maximum_matching(G: nx.Graph) -> Set[Tuple[str, str]]:
-    """Finds the optimal pairs using NetworkX"""
+def build_compatibility_graph(users: Iterable[Dict], history: Dict[str, List[str]]) -> nx.Graph:
+    """
+    Nodes = People (by int id, see index_participants)
+    Edges = Possible matches (only if they haven't matched before)
+    """
+    users = index_participants(users)
+    id_of = {user['email']: i for i, user in enumerate(users)}
+    met_pairs = history_to_id_pairs(history, id_of)
+    return _graph_from_mask(build_compatibility_mask(users, met_pairs), users)
+
+def find_maximum_matching(G: nx.Graph) -> List[Tuple[int, int]]:
+    """Finds the optimal pairs using NetworkX (G is only read, never mutated)"""
     matching_set = nx.max_weight_matching(G, maxcardinality=True)
-    return {tuple(sorted([n1, n2])) for n1, n2 in matching_set}
+    return [_canon(n1, n2) for n1, n2 in matching_set]
 
-def create_triad(matches: Set[Tuple[str, str]], 
+def greedy_matching(mask: np.ndarray) -> List[Tuple[int, int]]:
+    """
+    Fast approximate matching for large groups.
+    Repeatedly pairs the free person with the fewest compatible free peers
+    (the hardest to place) with their least-connected compatible peer, then
+    re-solves exactly around anyone left over (see _repair_matching).
+    """
+    n = len(mask)
+    free = np.ones(n, dtype=bool)
+    degree = mask.sum(axis=1)  # compatible free peers per person
+    pairs = []
+    
+    while True:
+        candidates = np.flatnonzero(free & (degree > 0))
+        if not candidates.size:
+            break
+        u = candidates[np.argmin(degree[candidates])]
+        peers = np.flatnonzero(mask[u] & free)
+        v = peers[np.argmin(degree[peers])]
+        free[u] = free[v] = False
+        degree = degree - mask[u] - mask[v]
+        pairs.append(_canon(int(u), int(v)))
+    
+    return _repair_matching(mask, pairs)
+
+def _repair_matching(mask: np.ndarray, pairs: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    Re-runs the exact solver on the neighbourhood of the people greedy left
+    out: the leftovers, their compatible (already matched) peers, and those
+    peers' partners. Repeats while that region stays small and pairs improve.
+    """
+    n = len(mask)
+    while True:
+        partner = np.full(n, -1)
+        for a, b in pairs:
+            partner[a], partner[b] = b, a
+        leftover = np.flatnonzero(partner < 0)
+        if leftover.size < 2:
+            return pairs
+        
+        near = np.flatnonzero(mask[leftover].any(axis=0))
+        region = np.union1d(np.union1d(leftover, near), partner[near])
+        if region.size > HEURISTIC_THRESHOLD:
+            return pairs
+        
+        # Every current pair lies either fully inside or fully outside the region
+        in_region = np.zeros(n, dtype=bool)
+        in_region[region] = True
+        outside = [pair for pair in pairs if not in_region[pair[0]]]
+        sub = nx.from_numpy_array(mask[np.ix_(region, region)], edge_attr=None)
+        inside = [_canon(int(region[a]), int(region[b]))
+                  for a, b in nx.max_weight_matching(sub, maxcardinality=True)]
+        if len(outside) + len(inside) <= len(pairs):
+            return pairs
+        pairs = outside + inside
+
+def create_triad(matches: List[Tuple[int, int]], 
                 all_users: List[Dict], 
-                history: Dict[str, List[str]]) -> Optional[Tuple[str, str, str]]:
+                history: Set[Tuple[int, int]]) -> Optional[Tuple[int, int, int]]:
     """Handles the 'odd person out' by creating a group of 3"""
-    matched_emails = {email for pair in matches for email in pair}
-    all_emails = {u['email'] for u in all_users}
-    unmatched = list(all_emails - matched_emails)
+    matched_ids = frozenset(i for pair in matches for i in pair)
+    # Only the first unmatched person is needed, so stop at them
+    unmatched_id = next((i for i in range(len(all_users)) if i not in matched_ids), None)
     
-    if not unmatched:
+    if unmatched_id is None:
         return None
     
-    unmatched_email = unmatched[0]
-    unmatched_history = set(history.get(unmatched_email, []))
+    unmatched_history = {j for pair in history if unmatched_id in pair for j in pair}
     
     # Prioritize a pair where the unmatched person hasn't met either member
     for pair in matches:
         if pair[0] not in unmatched_history and pair[1] not in unmatched_history:
-            return (pair[0], pair[1], unmatched_email)
+            return (pair[0], pair[1], unmatched_id)
     
     # Fallback: Just pick the first available pair
     if matches:
-        lucky_pair = list(matches)[0]
-        return (lucky_pair[0], lucky_pair[1], unmatched_email)
+        lucky_pair = matches[0]
+        return (lucky_pair[0], lucky_pair[1], unmatched_id)
     return None
 
 # ==========================================
 # 2. INTEGRATION WRAPPERS (The "Translator")
 # ==========================================
 
-def transform_sheet_history_to_dict(history_rows: List[Dict]) -> Dict[str, List[str]]:
+def transform_sheet_history_to_dict(history_df: pd.DataFrame) -> Dict[str, List[str]]:
     """
-    Turns the 'MatchHistory' tab rows into a lookup dictionary.
-    Expects keys: 'Person A (Email)', 'Person B (Email)'
+    Turns the 'MatchHistory' tab into a lookup dictionary.
+    Expects columns: 'Person A (Email)', 'Person B (Email)'
     """
-    history_dict = {}
-    for row in history_rows:
-        p1 = row.get('Person A (Email)')
-        p2 = row.get('Person B (Email)')
-        
-        if p1 and p2:
-            history_dict.setdefault(p1, []).append(p2)
-            history_dict.setdefault(p2, []).append(p1)
-    return history_dict
-
-def format_matches_for_tray(matches: Set[Tuple[str, str]], triad: Optional[Tuple], users: List[Dict]) -> List[Dict]:
-    """Prepares a clean list for Tray to loop through for Braze emails"""
-    lookup = {u['email']: u for u in users}
+    if not set(HISTORY_COLUMNS).issubset(history_df.columns):
+        return {}
+    
+    # Skip rows missing either person (blank cells arrive as NaN or '')
+    # and repeat matches, which would only add duplicate entries
+    pairs = history_df[HISTORY_COLUMNS]
+    pairs = pairs[(pairs.notna() & (pairs != '')).all(axis=1)].drop_duplicates()
+    
+    # Each row is a meeting for both people, so group it from both sides
+    # (dict.fromkeys also drops pairs logged once as A-B and once as B-A)
+    col_a, col_b = HISTORY_COLUMNS
+    fwd = pairs.groupby(col_a)[col_b].apply(list).to_dict()
+    rev = pairs.groupby(col_b)[col_a].apply(list).to_dict()
+    return {k: list(dict.fromkeys(fwd.get(k, []) + rev.get(k, []))) for k in fwd.keys() | rev.keys()}
+
+def index_participants(users: Iterable[Dict]) -> List[Dict]:
+    """
+    One record per email. Inside the engine a person's int id is their
+    position in this list; emails only come back when formatting for Tray.
+    Consumes `users` once, so any iterable (e.g. a generator) works.
+    """
+    return list({u['email']: u for u in users}.values())
+
+def history_to_id_pairs(history: Dict[str, List[str]], id_of: Dict[str, int]) -> Set[Tuple[int, int]]:
+    """Past matches among the given people, as (lower id, higher id) pairs"""
+    pairs = set()
+    for email1, past_matches in history.items():
+        i = id_of.get(email1)
+        if i is None:
+            continue
+        for email2 in past_matches:
+            j = id_of.get(email2)
+            if j is not None and j != i:
+                pairs.add(_canon(i, j))
+    return pairs
+
+def _as_dict(user) -> Dict:
+    """Participants may arrive as dicts or numpy records (DataFrame.to_records)"""
+    return user if isinstance(user, dict) else dict(zip(user.dtype.names, user.item()))
+
+def format_matches_for_tray(matches: List[Tuple[int, int]], triad: Optional[Tuple], users: List[Dict]) -> List[Dict]:
+    """
+    Prepares a clean list for Tray to loop through for Braze emails.
+    Ids index into `users`; the pair that was converted into the triad
+    is skipped in the same pass.
+    """
+    triad_base = triad[:2] if triad else None
     payload = []
     
-    for email1, email2 in matches:
+    for pair in matches:
+        if pair == triad_base:
+            continue
+        id1, id2 = pair
         payload.append({
             "match_type": "pair",
-            "person_a": lookup[email1],
-            "person_b": lookup[email2]
+            "person_a": _as_dict(users[id1]),
+            "person_b": _as_dict(users[id2])
         })
         
     if triad:
         payload.append({
             "match_type": "triad",
-            "person_a": lookup[triad[0]],
-            "person_b": lookup[triad[1]],
-            "person_c": lookup[triad[2]]
+            "person_a": _as_dict(users[triad[0]]),
+            "person_b": _as_dict(users[triad[1]]),
+            "person_c": _as_dict(users[triad[2]])
         })
     return payload
 
@@ -105,34 +223,57 @@ def format_matches_for_tray(matches: Set[Tuple[str, str]], triad: Optional[Tuple
 # 3. MAIN WORKFLOW EXECUTION
 # ==========================================
 
-def run_matching_workflow(active_participants: List[Dict], raw_history: List[Dict]):
+def run_matching_workflow(active_participants: Iterable[Dict], raw_history: pd.DataFrame,
+                          formatted_history: Optional[Dict[str, List[str]]] = None,
+                          G: Optional[nx.Graph] = None,
+                          report_unmatched: bool = False):
     """
     The main entry point for your UI or Tray Trigger.
     
     Args:
-        active_participants: List of users from 'Participants' tab (filtered for PTO)
-        raw_history: List of rows from the 'MatchHistory' tab
+        active_participants: Users from 'Participants' tab (filtered for PTO), as dicts
+                             or numpy records; any iterable, read once
+        raw_history: The 'MatchHistory' tab as a DataFrame
+        formatted_history: Optional precomputed history lookup (e.g. cached by the UI)
+        G: Optional precomputed compatibility graph for these participants
+           (unused above HEURISTIC_THRESHOLD)
+        report_unmatched: Also return the participant records nobody could be
+           paired with (e.g. they've already met everyone)
+    
+    Returns:
+        The Tray payload, or (payload, unmatched) if report_unmatched is set
     """
-    # 1. Prepare history
-    formatted_history = transform_sheet_history_to_dict(raw_history)
+    # 1. Prepare history and int ids
+    users = index_participants(active_participants)
+    id_of = {u['email']: i for i, u in enumerate(users)}
+    if formatted_history is None:
+        formatted_history = transform_sheet_history_to_dict(raw_history)
+    met_pairs = history_to_id_pairs(formatted_history, id_of)
     
-    # 2. Build Graph and find pairs
-    G = build_compatibility_graph(active_participants, formatted_history)
-    matches = find_maximum_matching(G)
+    # 2. Find pairs (exact on a graph for normal sizes, greedy for large groups)
+    if len(users) > HEURISTIC_THRESHOLD:
+        matches = greedy_matching(build_compatibility_mask(users, met_pairs))
+    else:
+        if G is None:
+            G = _graph_from_mask(build_compatibility_mask(users, met_pairs), users)
+        matches = find_maximum_matching(G)
     
-    # 3. Handle odd numbers
+    # 3. Handle odd numbers (the triad's base pair is dropped while formatting)
     triad = None
-    if len(active_participants) % 2 != 0:
-        triad = create_triad(matches, active_participants, formatted_history)
-        if triad:
-            # Remove the pair that was converted into a triad
-            matches.remove(tuple(sorted([triad[0], triad[1]])))
+    if len(users) % 2 != 0:
+        triad = create_triad(matches, users, met_pairs)
     
-    # 4. Return formatted results
-    return format_matches_for_tray(matches, triad, active_participants)
+    # 4. Map ids back to participant records
+    payload = format_matches_for_tray(matches, triad, users)
+    if not report_unmatched:
+        return payload
+    placed = {i for pair in matches for i in pair}
+    if triad:
+        placed.add(triad[2])
+    return payload, [_as_dict(u) for i, u in enumerate(users) if i not in placed]
 
 # Example usage (for testing):
 # if __name__ == "__main__":
 #     users = [{"email": "a@test.com", "name": "Alice"}, {"email": "b@test.com", "name": "Bob"}]
-#     history = [{"Person A (Email)": "a@test.com", "Person B (Email)": "b@test.com"}]
+#     history = pd.DataFrame([{"Person A (Email)": "a@test.com", "Person B (Email)": "b@test.com"}])
 #     print(run_matching_workflow(users, history))